@@ -1,9 +1,10 @@
 import asyncio
 import inspect
-import json
 import re
 import zlib
-from typing import Any, Dict, List, Type, Union, Callable, Optional, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Any, Dict, List, Set, Tuple, Type, Union, Callable, Optional, FrozenSet
 
 from nonebot.adapters import Adapter as BaseAdapter
 from nonebot.drivers import (
@@ -16,31 +17,62 @@ from nonebot.drivers import (
 from nonebot.internal.driver import Response
 from nonebot.typing import overrides
 from nonebot.utils import escape_tag
-from pydantic import parse_obj_as
+from pydantic import BaseModel, parse_obj_as
 from pygtrie import StringTrie
 
-from . import event
 from .api.handle import get_api_method, get_api_restype
 from .bot import Bot
 from .config import Config as KaiheilaConfig
 from .event import *
-from .event import OriginEvent
+from .event import _EVENT_REGISTRY
 from .exception import ApiNotAvailable, ReconnectError, TokenError, UnauthorizedException, RateLimitException, \
     ActionFailed, KaiheilaAdapterException, NetworkError
 from .message import Message, MessageSegment
-from .utils import ResultStore, log, _handle_api_result
+from .utils import ResultStore, log, _handle_api_result, json_loads
 
 RECONNECT_INTERVAL = 3.0
+PARSE_OFFLOAD_SIZE = 1024
+"""开启压缩时，超过该长度的 websocket 帧在线程池中解压与解析，避免阻塞事件循环"""
+
+_CAMEL_RE = re.compile(r'[A-Z]')
+_HEARTBEAT_TEMPLATE = '{"s":2,"sn":%d}'
+_API_TRANS = str.maketrans({"_": "/"})
+_EVENT_SUBTYPE_BY_VALUE: Dict[int, str] = {i.value: i.name.lower() for i in EventTypes}
+
+
+@lru_cache(maxsize=None)
+def _get_result_parser(result_type: Any) -> Callable[[Any], Any]:
+    """
+    :说明:
+
+      获取 API 返回类型对应的解析函数，模型类直接使用 ``parse_obj``，避免 ``parse_obj_as`` 的包装开销
+    """
+    if inspect.isclass(result_type) and issubclass(result_type, BaseModel):
+        return result_type.parse_obj
+    return partial(parse_obj_as, result_type)
+
+
+def _decompress_and_load(data: bytes) -> Any:
+    return json_loads(zlib.decompress(data))
+
+
+@lru_cache(maxsize=None)
+def _get_required_fields(model: Type[Event]) -> FrozenSet[str]:
+    """
+    :说明:
+
+      获取事件模型的必填字段（按别名），用于在校验前排除必然失败的模型
+    """
+    return frozenset(field.alias for field in model.__fields__.values() if field.required)
 
 
 class Adapter(BaseAdapter):
     # init all event models
     event_models: StringTrie = StringTrie(separator=".")
-    for model_name in dir(event):
-        model = getattr(event, model_name)
-        if not inspect.isclass(model) or not issubclass(model, OriginEvent):
-            continue
-        event_models["." + model.__event__] = model
+    for _name, _model in _EVENT_REGISTRY.items():
+        event_models["." + _name] = _model
+    del _name, _model
+    _event_model_cache: Dict[str, Tuple[Type[Event], ...]] = {}
 
     @overrides(BaseAdapter)
     def __init__(self, driver: Driver, **kwargs: Any):
@@ -49,6 +81,9 @@ class Adapter(BaseAdapter):
         self.api_root = f'https://www.kaiheila.cn/api/v3/'
         self.connections: Dict[str, WebSocket] = {}
         self.tasks: List[asyncio.Task] = []
+        self.event_semaphore: Optional[asyncio.Semaphore] = None
+        self.event_tasks: Set[asyncio.Task] = set()
+        self.parse_pool: Optional[ThreadPoolExecutor] = None
         self.setup()
 
     # OK
@@ -65,6 +100,13 @@ class Adapter(BaseAdapter):
                 f"Current driver {self.config.driver} don't support forward connections! Ignored",
             )
         else:
+            if self.kaiheila_config.use_uvloop:
+                try:
+                    import uvloop
+
+                    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+                except ImportError:
+                    log("WARNING", "uvloop is not installed, fallback to asyncio event loop")
             self.driver.on_startup(self.start_forward)
             self.driver.on_shutdown(self.stop_forward)
             self.driver.on_bot_connect(self.start_heartbeat)
@@ -96,51 +138,49 @@ class Adapter(BaseAdapter):
             if not self.api_root:
                 raise ApiNotAvailable()
 
-            match = re.findall(r'[A-Z]', api)
-            if len(match) > 0:
-                for m in match:
-                    api = api.replace(m, "-" + m.lower())
-            api = api.replace("_", "/")
-
-            if api.startswith("/api/v3/"):
-                api = api[len("/api/v3/"):]
-            elif api.startswith("api/v3"):
-                api = api[len("api/v3"):]
-            api = api.strip("/")
-            return await self._do_call_api(api, data, bot.token)
+            # camelCase -> kebab-case, 同时将 _ 转换为 /
+            api = _CAMEL_RE.sub(lambda m: "-" + m.group(0).lower(), api).translate(_API_TRANS)
+            api = api.removeprefix("/api/v3/").removeprefix("api/v3").strip("/")
+            return await self._do_call_api(api, data, bot=bot)
 
         else:
             raise ApiNotAvailable
 
     async def _do_call_api(self, api: str,
-                           data: Optional[Mapping[str, Any]] = None,
-                           token: Optional[str] = None) -> Any:
+                           data: Optional[Dict[str, Any]] = None,
+                           token: Optional[str] = None,
+                           bot: Optional[Bot] = None) -> Any:
         log("DEBUG", f"Calling API <y>{api}</y>")
-        data = dict(data) if data is not None else dict()
+        # data 由调用方构造并移交所有权（如 _call_api 的 **data），无需再复制一份
+        if data is None:
+            data = {}
 
         # 判断 POST 或 GET
         method = get_api_method(api) if not data.get("method") else data.get("method")
 
-        headers = data.get("headers", {})
+        headers = data.pop("headers", None)
 
         files = None
         query = None
         body = None
 
         if "files" in data:
-            files = data["files"]
-            del data["files"]
+            files = data.pop("files")
         elif "file" in data:  # 目前只有asset/create接口需要上传文件（大概）
-            files = {"file": data["file"]}
-            del data["file"]
+            files = {"file": data.pop("file")}
 
         if method == "GET":
             query = data
         elif method == "POST":
             body = data
 
-        if token is not None:
-            headers["Authorization"] = f"Bot {token}"
+        if bot is not None:
+            auth_headers = bot._auth_headers
+        elif token is not None:
+            auth_headers = {"Authorization": f"Bot {token}"}
+        else:
+            auth_headers = {}
+        headers = {**headers, **auth_headers} if headers else auth_headers
 
         request = Request(
             method,
@@ -155,7 +195,7 @@ class Adapter(BaseAdapter):
         try:
             resp = await self.request(request)
             result = _handle_api_result(resp)
-            return parse_obj_as(result_type, result) if result_type else None
+            return _get_result_parser(result_type)(result) if result_type else None
         except Exception as e:
             raise e
 
@@ -169,6 +209,11 @@ class Adapter(BaseAdapter):
         return result.url
 
     async def start_forward(self) -> None:
+        # 限制尚未处理完的事件数，事件堆积时阻塞 websocket 的接收
+        self.event_semaphore = asyncio.Semaphore(self.kaiheila_config.event_queue_size)
+        # 只有 zlib 解压会释放 GIL，未开启压缩时放到线程池中没有收益
+        if self.kaiheila_config.compress:
+            self.parse_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="kaiheila-parse")
         for bot in self.kaiheila_config.kaiheila_bots:
             bot_token = bot.token
             try:
@@ -191,11 +236,30 @@ class Adapter(BaseAdapter):
                 )
 
     async def stop_forward(self) -> None:
-        for task in self.tasks:
+        tasks = [*self.tasks, *self.event_tasks]
+        self.tasks, self.event_tasks = [], set()
+        for task in tasks:
             if not task.done():
                 task.cancel()
 
-        await asyncio.gather(*self.tasks, return_exceptions=True)
+        # 已结束的任务也一并 gather，以取回其异常
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown(wait=False)
+            self.parse_pool = None
+
+    async def _handle_event(self, bot: Bot, event: Event, semaphore: asyncio.Semaphore) -> None:
+        try:
+            await bot.handle_event(event)
+        except Exception as e:
+            log(
+                "ERROR",
+                "<r><bg #f8bbd0>Error while handle event "
+                f"for bot {escape_tag(bot.self_id)}</bg #f8bbd0></r>",
+                e,
+            )
+        finally:
+            semaphore.release()
 
     async def _forward_ws(self, url: URL, bot_token: str) -> None:
         headers = {}
@@ -206,6 +270,15 @@ class Adapter(BaseAdapter):
         request = Request("GET", url, headers=headers)
 
         bot: Optional[Bot] = None
+        self_id: Optional[str] = None
+
+        # 接收循环中频繁使用，预先绑定为局部变量
+        compress = self.kaiheila_config.compress
+        json_to_event = self.json_to_event
+        event_semaphore = self.event_semaphore
+        event_tasks = self.event_tasks
+        parse_pool = self.parse_pool
+        loop = asyncio.get_running_loop()
 
         while True:
             try:
@@ -215,12 +288,15 @@ class Adapter(BaseAdapter):
                         f"WebSocket Connection to {escape_tag(str(url))} established",
                     )
                     try:
-                        data_decompress_func = zlib.decompress if self.kaiheila_config.compress else lambda x: x
                         while True:
                             data = await ws.receive()
-                            data = data_decompress_func(data)
-                            json_data = json.loads(data)
-                            event = self.json_to_event(json_data, bot and bot.self_id)
+                            if compress and len(data) >= PARSE_OFFLOAD_SIZE:
+                                json_data = await loop.run_in_executor(
+                                    parse_pool, _decompress_and_load, data
+                                )
+                            else:
+                                json_data = json_loads(zlib.decompress(data) if compress else data)
+                            event = json_to_event(json_data, self_id)
                             if not event:
                                 continue
                             if not bot:
@@ -239,7 +315,11 @@ class Adapter(BaseAdapter):
                                     "INFO",
                                     f"<y>Bot {escape_tag(self_id)}</y> connected",
                                 )
-                            asyncio.create_task(bot.handle_event(event))
+                            # 每个事件一个任务，未处理完的事件过多时在此等待
+                            await event_semaphore.acquire()
+                            task = asyncio.create_task(self._handle_event(bot, event, event_semaphore))
+                            event_tasks.add(task)
+                            task.add_done_callback(event_tasks.discard)
                     except ReconnectError as e:
                         log(
                             "ERROR",
@@ -272,6 +352,7 @@ class Adapter(BaseAdapter):
                             self.connections.pop(bot.self_id, None)
                             self.bot_disconnect(bot)
                             bot = None
+                            self_id = None
             except Exception as e:
                 log(
                     "ERROR",
@@ -287,13 +368,12 @@ class Adapter(BaseAdapter):
         每30s一次心跳
         :return:
         """
-        while self.connections.get(bot.self_id):
-            if self.connections.get(bot.self_id).closed:
+        while True:
+            ws = self.connections.get(bot.self_id)
+            if ws is None or ws.closed:
                 break
-            await self.connections.get(bot.self_id).send(json.dumps({
-                "s": 2,
-                "sn": ResultStore.get_sn(bot.self_id)  # 客户端目前收到的最新的消息 sn
-            }))
+            # 客户端目前收到的最新的消息 sn
+            await ws.send(_HEARTBEAT_TEMPLATE % ResultStore.get_sn(bot.self_id))
             await asyncio.sleep(26)
 
     @classmethod
@@ -305,7 +385,10 @@ class Adapter(BaseAdapter):
 
         signal = json_data['s']
 
-        if signal == SignalTypes.HELLO:
+        # EVENT 信令占绝大多数，优先判断
+        if signal == SignalTypes.EVENT:
+            ResultStore.set_sn(self_id, json_data["sn"])
+        elif signal == SignalTypes.HELLO:
             if json_data['d']['code'] == 0:
                 data = json_data['d']
                 data["post_type"] = "meta_event"
@@ -327,51 +410,56 @@ class Adapter(BaseAdapter):
                 f"<y>Bot {escape_tag(str(self_id))}</y> HeartBeat",
             )
             return HeartbeatMetaEvent.parse_obj(data)
-        elif signal == SignalTypes.EVENT:
-            ResultStore.set_sn(self_id, json_data["sn"])
         elif signal == SignalTypes.RECONNECT:
             raise ReconnectError
         elif signal == SignalTypes.RESUME_ACK:
             # 不存在的signal，resume是不可能resume的，这辈子都不会resume的，出了问题直接重连
             return
 
+        data = json_data['d']
+        author_id = data.get("author_id")
+
         # 屏蔽 Bot 自身的消息
-        if json_data["d"].get("author_id") == self_id:
+        if author_id == self_id:
             return
 
         try:
-            data = json_data['d']
             extra = data.get("extra")
 
             data['self_id'] = self_id
             data['group_id'] = data.get('target_id')
             data['time'] = data.get('msg_timestamp')
-            data['user_id'] = data.get('author_id') if data.get('author_id') != "1" else "SYSTEM"
+            data['user_id'] = author_id if author_id != "1" else "SYSTEM"
 
             if data['type'] == EventTypes.sys:
-                data['post_type'] = "notice"
-                data['notice_type'] = extra.get('type')
+                post_type = "notice"
+                detail_type = extra.get('type')
+                data['notice_type'] = detail_type
                 message = Message.template("{}").format(data["content"])
                 data['message'] = message
                 # data['notice_type'] = data.get('channel_type').lower()
                 # data['notice_type'] = 'private' if data['notice_type'] == 'person' else data['notice_type']
             else:
-                data['post_type'] = "message"
-                data['sub_type'] = [i.name.lower() for i in EventTypes if i.value == extra.get('type')][0]
-                data['message_type'] = data.get('channel_type').lower()
-                data['message_type'] = 'private' if data['message_type'] == 'person' else data['message_type']
-                data['extra']['content'] = data.get('content')
-                data['event'] = data['extra']
-
+                post_type = "message"
+                data['sub_type'] = _EVENT_SUBTYPE_BY_VALUE[extra.get('type')]
+                channel_type = data.get('channel_type').lower()
+                detail_type = 'private' if channel_type == 'person' else channel_type
+                data['message_type'] = detail_type
+                extra['content'] = data.get('content')
+                data['event'] = extra
+
+            data['post_type'] = post_type
             data['message_id'] = data.get('msg_id')
-            post_type = data['post_type']
-            detail_type = data.get(f"{post_type}_type")
             detail_type = f".{detail_type}" if detail_type else ""
             sub_type = data.get('sub_type')
             sub_type = f".{sub_type}" if sub_type else ""
 
-            models = cls.get_event_model(post_type + detail_type + sub_type)
+            models = cls._get_event_models(post_type + detail_type + sub_type)
+            keys = data.keys()
             for model in models:
+                # 缺少必填字段的模型必然校验失败，直接跳过以免白白抛出 ValidationError
+                if not _get_required_fields(model) <= keys:
+                    continue
                 try:
                     event = model.parse_obj(data)
                     break
@@ -394,6 +482,21 @@ class Adapter(BaseAdapter):
         if not model.__event__:
             raise ValueError("Event model's `__event__` attribute must be set")
         cls.event_models["." + model.__event__] = model
+        cls._rebuild_event_model_cache()
+
+    @classmethod
+    def _rebuild_event_model_cache(cls) -> None:
+        """
+        :说明:
+
+          为每个已注册的事件名预先计算 ``get_event_model`` 的结果，未注册的事件名在首次查询时再写入缓存
+        """
+        cls._event_model_cache.clear()
+        for key in cls.event_models.keys():
+            event_name = key[1:]
+            cls._event_model_cache[event_name] = tuple(
+                [model.value for model in cls.event_models.prefixes(key)][::-1]
+            )
 
     @classmethod
     def get_event_model(cls, event_name: str) -> List[Type[Event]]:
@@ -406,9 +509,17 @@ class Adapter(BaseAdapter):
 
           - ``List[Type[Event]]``
         """
-        return [model.value for model in cls.event_models.prefixes("." + event_name)][
-               ::-1
-               ]
+        return list(cls._get_event_models(event_name))
+
+    @classmethod
+    def _get_event_models(cls, event_name: str) -> Tuple[Type[Event], ...]:
+        models = cls._event_model_cache.get(event_name)
+        if models is None:
+            models = tuple(
+                [model.value for model in cls.event_models.prefixes("." + event_name)][::-1]
+            )
+            cls._event_model_cache[event_name] = models
+        return models
 
     @classmethod
     def custom_send(
@@ -416,3 +527,6 @@ class Adapter(BaseAdapter):
             send_func: Callable[[Bot, Event, Union[str, Message, MessageSegment]], None],
     ):
         setattr(Bot, "send_handler", send_func)
+
+
+Adapter._rebuild_event_model_cache()
@@ -147,6 +147,7 @@ class Bot(BaseBot, ApiClient):
         super().__init__(adapter, self_id)
         self.self_name: str = name
         self.token: str = token
+        self._auth_headers: Dict[str, str] = {"Authorization": f"Bot {token}"}
 
     @overrides(BaseBot)
     async def call_api(self, api: str, **data) -> Any:
@@ -24,6 +24,8 @@ class Config(BaseModel):
 
       - ``kaiheila_bots`` : Kaiheila 开发者中心获得
       - ``compress`` : 是否开启压缩, 默认为 False
+      - ``event_queue_size`` : 尚未处理完的事件数上限，达到上限时暂停接收新事件, 默认为 1024
+      - ``use_uvloop`` : 是否使用 uvloop 作为事件循环（需要安装 uvloop）, 默认为 False
 
     :示例:
 
@@ -33,6 +35,8 @@ class Config(BaseModel):
     """
     kaiheila_bots: List["BotConfig"] = Field(default_factory=list)
     compress: Optional[bool] = Field(default=False)
+    event_queue_size: int = Field(default=1024, gt=0)
+    use_uvloop: bool = Field(default=False)
 
     class Config:
         extra = "allow"
@@ -1,6 +1,5 @@
-import inspect
 from enum import IntEnum
-from typing import List, Type, Optional, Union
+from typing import Dict, List, Type, Optional, Union
 
 from nonebot.adapters import Event as BaseEvent
 from nonebot.typing import overrides
@@ -92,6 +91,10 @@ class Extra(BaseModel):
         arbitrary_types_allowed = True
 
 
+_EVENT_REGISTRY: Dict[str, Type["OriginEvent"]] = {}
+"""已定义的事件模型，键为 ``__event__``，由 ``OriginEvent.__init_subclass__`` 填充"""
+
+
 class OriginEvent(BaseEvent):
     """为了区分信令中非Event事件，增加了前置OriginEvent"""
 
@@ -99,6 +102,13 @@ class OriginEvent(BaseEvent):
 
     post_type: str
 
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        # 与原先按模块扫描的结果保持一致：同一 __event__ 以最后定义的模型为准
+        event_name = getattr(cls, "__event__", None)
+        if event_name is not None:
+            _EVENT_REGISTRY[event_name] = cls
+
     @overrides(BaseEvent)
     def get_type(self) -> str:
         return self.post_type
@@ -923,13 +933,9 @@ class HeartbeatMetaEvent(MetaEvent):
 
 
 _t = StringTrie(separator=".")
-
-# define `model` first to avoid globals changing while `for`
-model = None
-for model in globals().values():
-    if not inspect.isclass(model) or not issubclass(model, OriginEvent):
-        continue
-    _t["." + model.__event__] = model
+for _name, _model in _EVENT_REGISTRY.items():
+    _t["." + _name] = _model
+del _name, _model
 
 
 def get_event_model(event_name) -> List[Type[OriginEvent]]:
@@ -11,6 +11,19 @@ from .exception import ActionFailed
 
 log = logger_wrapper("Kaiheila")
 
+# orjson / msgspec 为可选依赖，依次尝试，均未安装时回退到标准库 json
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import msgspec
+
+        json_loads = msgspec.json.decode
+    except ImportError:
+        json_loads = json.loads
+
 
 def _b2s(b: Optional[bool]) -> Optional[str]:
     """转换布尔值为字符串。"""
@@ -72,7 +85,7 @@ def _handle_api_result(response: Response) -> Any:
 
         - ``ActionFailed``: API 调用失败
     """
-    result = json.loads(response.content)
+    result = json_loads(response.content)
     if isinstance(result, dict):
         log("DEBUG", "API result " + str(result))
         if result.get("code") != 0: